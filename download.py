@@ -1,13 +1,22 @@
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+import asyncio
+import aiohttp
+import aiofiles
+from datetime import datetime, timedelta, timezone
 import os
 import time
+import random
+import threading
 from tqdm import tqdm
 import logging
 from pathlib import Path
-import json
-from shapely.geometry import Polygon
+import orjson
+import hashlib
+import tempfile
 import getpass
+from shapely import wkt
+from shapely.ops import unary_union
 
 # Configure logging
 logging.basicConfig(
@@ -17,6 +26,190 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Retry backoff settings (seconds), capped separately per endpoint
+SEARCH_BACKOFF_BASE = 5
+SEARCH_MAX_BACKOFF = 300
+DOWNLOAD_BACKOFF_BASE = 30
+DOWNLOAD_MAX_BACKOFF = 600
+
+# Downloads have no overall time limit, only connect and stalled-read limits
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
+
+# Buffer downloads into 1 MiB writes to keep per-write Python overhead low
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Products are fetched as up to this many parallel byte ranges, as free download slots allow
+DOWNLOAD_RANGE_PARTS = 4
+
+# Times a product is re-queued after HTTP 429 before it is counted as failed
+MAX_RATE_LIMIT_RETRIES = 5
+
+# Seconds without HTTP 429 before a throttled download limit is raised again
+RATE_LIMIT_COOLDOWN = 60
+
+# Élargir les zones de recherche pour le Maroc
+REGION_BOUNDS = {
+    'north': {
+        'min_lon': -7.0,  # Élargi vers l'ouest
+        'max_lon': -1.0,  # Élargi vers l'est
+        'min_lat': 32.0,  # Ajusté pour le nord du Maroc
+        'max_lat': 36.0
+    },
+    'central': {
+        'min_lon': -13.0,  # Élargi pour inclure la côte
+        'max_lon': -2.0,
+        'min_lat': 29.0,
+        'max_lat': 32.0
+    },
+    'south': {
+        'min_lon': -13.0,
+        'max_lon': -1.0,
+        'min_lat': 26.0,  # Ajusté pour le sud du Maroc
+        'max_lat': 29.0
+    }
+}
+
+# Search polygons are constant, build their WKT once at import time
+REGION_WKT = {
+    region: f"POLYGON(({bounds['min_lon']} {bounds['min_lat']}, "
+            f"{bounds['max_lon']} {bounds['min_lat']}, "
+            f"{bounds['max_lon']} {bounds['max_lat']}, "
+            f"{bounds['min_lon']} {bounds['max_lat']}, "
+            f"{bounds['min_lon']} {bounds['min_lat']}))"
+    for region, bounds in REGION_BOUNDS.items()
+}
+
+# Shapely geometries used to assign product footprints to regions
+REGION_SHAPES = {region: wkt.loads(polygon) for region, polygon in REGION_WKT.items()}
+
+def backoff_delay(attempt, base, max_backoff, rng=random):
+    """Exponential backoff with full jitter"""
+    return rng.uniform(0, min(max_backoff, base * (2 ** attempt)))
+
+async def iter_buffered(content, size=DOWNLOAD_CHUNK_SIZE):
+    """Yield at least size bytes at a time (less only at the end) from an aiohttp stream"""
+    # aiohttp hands out whatever is buffered, typically at most 256 KiB, so collect it here
+    buffer = bytearray()
+    async for data in content.iter_any():
+        buffer += data
+        if len(buffer) >= size:
+            yield buffer
+            buffer = bytearray()
+    if buffer:
+        yield buffer
+
+def pwrite_all(fd, data, offset):
+    """Write all of data at offset, os.pwrite may write less than asked"""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        if written == 0:
+            raise OSError(f"Short write at offset {offset}")
+        view = view[written:]
+        offset += written
+
+def merge_ranges(ranges):
+    """Merge overlapping or touching [start, end) byte ranges"""
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+def missing_ranges(done, total_size):
+    """[start, end) byte ranges of 0..total_size not covered by done"""
+    missing = []
+    position = 0
+    for lo, hi in merge_ranges(done):
+        if lo > position:
+            missing.append((position, lo))
+        position = max(position, hi)
+    if position < total_size:
+        missing.append((position, total_size))
+    return missing
+
+def preallocate_file(fd, size):
+    """Reserve disk space up front so large files are written in few extents"""
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not available on this platform or filesystem
+        pass
+
+def drop_file_cache(fd, size):
+    """Tell the kernel the written pages won't be read again"""
+    try:
+        # Only clean pages are dropped, so write them back first
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_DONTNEED)
+    except (AttributeError, OSError):
+        pass
+
+def cloud_cover_key(product):
+    """Cloud cover from the search's single expanded cloudCover attribute"""
+    attributes = product.get('Attributes')
+    return float(attributes[0]['Value']) if attributes else 100.0
+
+class RateLimitError(Exception):
+    """Raised when the download server answers with HTTP 429"""
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+class DownloadLimiter:
+    """Concurrency limit that shrinks after HTTP 429 and recovers after a quiet cool-down"""
+    def __init__(self, max_limit, cooldown=RATE_LIMIT_COOLDOWN):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self.cooldown = cooldown
+        self.last_change = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    async def acquire_extra(self, wanted):
+        """Take up to wanted free slots without waiting, returns how many were taken"""
+        async with self.condition:
+            taken = max(0, min(wanted, self.limit - self.active))
+            self.active += taken
+            return taken
+
+    async def release_extra(self, count):
+        """Give back slots taken with acquire_extra"""
+        async with self.condition:
+            self.active -= count
+            self.condition.notify_all()
+
+    async def throttled(self):
+        """Allow one less parallel download"""
+        async with self.condition:
+            if self.limit > 1:
+                self.limit -= 1
+                logger.warning(f"Rate limited, lowering parallel downloads to {self.limit}")
+            self.last_change = time.monotonic()
+
+    async def succeeded(self):
+        """Allow one more parallel download if there was no 429 during the cool-down"""
+        async with self.condition:
+            if self.limit < self.max_limit and time.monotonic() - self.last_change > self.cooldown:
+                self.limit += 1
+                self.last_change = time.monotonic()
+                logger.info(f"Raising parallel downloads to {self.limit}")
+                self.condition.notify_all()
+
 class MoroccoSentinelDownloader:
     def __init__(self, username, password):
         """Initialize with Data Space Ecosystem credentials"""
@@ -24,6 +217,20 @@ class MoroccoSentinelDownloader:
         self.password = password
         self.base_url = "https://catalogue.dataspace.copernicus.eu/odata/v1"
         self.download_base_url = "https://zipper.dataspace.copernicus.eu/odata/v1"
+        self.search_cache_dir = Path('.cdse_cache')
+        self.cloud_cover_cache = {}
+        
+        # Reuse keep-alive connections for token and search requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=0)
+        self.session.mount("https://catalogue.dataspace.copernicus.eu", adapter)
+        self.session.mount("https://identity.dataspace.copernicus.eu", adapter)
+        
+        # Token expiry is tracked so it can be refreshed before requests fail
+        self.token_expiry = 0
+        self.refresh_token = None
+        self.refresh_token_expiry = 0
+        self.token_lock = threading.Lock()
         
         # Get access token
         try:
@@ -34,104 +241,170 @@ class MoroccoSentinelDownloader:
             raise Exception("Could not connect to Copernicus Data Space. Please check your credentials.")
 
     def get_token(self):
-        """Get authentication token"""
+        """Get authentication token, using the refresh token while it is valid"""
         auth_url = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
-        data = {
-            'grant_type': 'password',
-            'username': self.username,
-            'password': self.password,
-            'client_id': 'cdse-public'
-        }
+        use_refresh_token = self.refresh_token and time.monotonic() < self.refresh_token_expiry
+        if use_refresh_token:
+            data = {
+                'grant_type': 'refresh_token',
+                'refresh_token': self.refresh_token,
+                'client_id': 'cdse-public'
+            }
+        else:
+            data = {
+                'grant_type': 'password',
+                'username': self.username,
+                'password': self.password,
+                'client_id': 'cdse-public'
+            }
         
-        response = requests.post(auth_url, data=data)
+        # Don't send the previous bearer token to the identity server
+        response = self.session.post(auth_url, data=data, headers={'Authorization': None})
         if response.status_code == 200:
-            self.token = response.json()['access_token']
+            token_data = response.json()
+            now = time.monotonic()
+            self.token = token_data['access_token']
+            # Renew 30 seconds early to leave room for in-flight requests
+            self.token_expiry = now + token_data.get('expires_in', 600) - 30
+            self.refresh_token = token_data.get('refresh_token')
+            self.refresh_token_expiry = now + token_data.get('refresh_expires_in', 0) - 30
             self.headers = {'Authorization': f'Bearer {self.token}'}
+            self.session.headers.update(self.headers)
+        elif use_refresh_token:
+            # Refresh token was rejected, log in again with the password
+            logger.warning("Token refresh failed, re-authenticating with password")
+            self.refresh_token = None
+            self.get_token()
         else:
             raise Exception(f"Authentication failed: {response.text}")
 
+    def ensure_token(self, force=False):
+        """Refresh the access token if it is about to expire, or always with force"""
+        with self.token_lock:
+            if force or time.monotonic() > self.token_expiry:
+                self.get_token()
+
     def create_search_polygon(self, region):
-        """Create search polygon for region"""
-        # Élargir les zones de recherche pour le Maroc
-        regions = {
-            'north': {
-                'min_lon': -7.0,  # Élargi vers l'ouest
-                'max_lon': -1.0,  # Élargi vers l'est
-                'min_lat': 32.0,  # Ajusté pour le nord du Maroc
-                'max_lat': 36.0
-            },
-            'central': {
-                'min_lon': -13.0,  # Élargi pour inclure la côte
-                'max_lon': -2.0,
-                'min_lat': 29.0,
-                'max_lat': 32.0
-            },
-            'south': {
-                'min_lon': -13.0,
-                'max_lon': -1.0,
-                'min_lat': 26.0,  # Ajusté pour le sud du Maroc
-                'max_lat': 29.0
-            }
-        }
+        """Return the search polygon (WKT) for region"""
+        return REGION_WKT.get(region)
+
+    def search_scenes(self, region, start_date, end_date, max_cloud_percentage=30, force_refresh=False):
+        """Search for scenes in a single region"""
+        footprint = self.create_search_polygon(region)
+        if not footprint:
+            logger.error(f"Invalid region: {region}")
+            return []
+        return self.search_area(footprint, region, start_date, end_date, max_cloud_percentage, force_refresh)
+
+    def search_regions(self, regions, start_date, end_date, max_cloud_percentage=30, force_refresh=False):
+        """Search all regions with one query and split the products by footprint"""
+        products_by_region = {region: [] for region in regions}
+        valid_regions = [region for region in regions if region in REGION_WKT]
+        for region in regions:
+            if region not in REGION_WKT:
+                logger.error(f"Invalid region: {region}")
+        if not valid_regions:
+            return products_by_region
         
-        if region not in regions:
-            return None
+        # Regions share edges, so merge them into one valid geometry rather than a MULTIPOLYGON
+        footprint = unary_union([REGION_SHAPES[region] for region in valid_regions]).wkt
+        products = self.search_area(
+            footprint, ", ".join(valid_regions), start_date, end_date, max_cloud_percentage, force_refresh
+        )
         
-        bounds = regions[region]
-        polygon = f"POLYGON(({bounds['min_lon']} {bounds['min_lat']}, "\
-                  f"{bounds['max_lon']} {bounds['min_lat']}, "\
-                  f"{bounds['max_lon']} {bounds['max_lat']}, "\
-                  f"{bounds['min_lon']} {bounds['max_lat']}, "\
-                  f"{bounds['min_lon']} {bounds['min_lat']}))"
+        for product in products:
+            try:
+                # Footprint looks like geography'SRID=4326;POLYGON ((...))'
+                product_shape = wkt.loads(product['Footprint'].split(';', 1)[-1].rstrip("'"))
+            except Exception as e:
+                logger.warning(f"Skipping {product.get('Name')}: invalid footprint ({str(e)})")
+                continue
+            matched = [region for region in valid_regions if product_shape.intersects(REGION_SHAPES[region])]
+            if not matched:
+                # The server tests on the sphere, where long east-west edges bulge past the planar
+                # rectangles, so a product it returned can miss every region here
+                nearest = min(valid_regions, key=lambda region: product_shape.distance(REGION_SHAPES[region]))
+                logger.info(f"{product.get('Name')} matches no region footprint, assigning it to nearest region {nearest}")
+                matched = [nearest]
+            for region in matched:
+                products_by_region[region].append(product)
         
-        return polygon
+        return products_by_region
 
-    def search_scenes(self, region, start_date, end_date, max_cloud_percentage=30):
-        """Search for scenes using CDSE API"""
+    def search_area(self, footprint, area_name, start_date, end_date, max_cloud_percentage=30, force_refresh=False):
+        """Search for scenes intersecting footprint using CDSE API"""
+        logger.info(f"Searching for L2A scenes in {area_name} from {start_date} to {end_date}")
+        
+        # Format dates
+        start_str = start_date.strftime("%Y-%m-%dT%H:%M:%SZ")
+        end_str = end_date.strftime("%Y-%m-%dT%H:%M:%SZ")
+        
+        # Simplified query with less restrictive filters
+        query = (
+            f"{self.base_url}/Products?$filter="
+            f"Collection/Name eq 'SENTINEL-2' "
+            f"and contains(Name,'MSIL2A') "
+            f"and OData.CSC.Intersects(area=geography'SRID=4326;{footprint}') "
+            f"and ContentDate/Start ge '{start_str}' "  # Changed gt to ge (greater or equal)
+            f"and ContentDate/Start le '{end_str}' "    # Changed lt to le (less or equal)
+            f"and Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' "
+            f"and att/Value le {max_cloud_percentage})"
+            f"&$orderby=ContentDate/Start desc"
+            # Page size; later pages are fetched through @odata.nextLink
+            f"&$top=1000"
+            # Only fetch the fields we use
+            f"&$select=Id,Name,Footprint"
+            f"&$expand=Attributes($filter=Name eq 'cloudCover';$select=Name,Value)"
+        )
+        
+        logger.debug(f"Query URL: {query}")  # Add this line to debug the query
+        
+        # Results for a closed historical date range don't change, reuse them
+        cache_file = self.search_cache_dir / f"{hashlib.sha1(query.encode()).hexdigest()}.json"
+        # Naive dates are treated as UTC, like the query strings above
+        end_utc = end_date if end_date.tzinfo else end_date.replace(tzinfo=timezone.utc)
+        results_stable = end_utc < datetime.now(timezone.utc) - timedelta(days=1)
+        if results_stable and not force_refresh and cache_file.exists():
+            try:
+                products = orjson.loads(cache_file.read_bytes())
+                logger.info(f"Loaded {len(products)} cached products for region {area_name}")
+                return products
+            except (orjson.JSONDecodeError, OSError) as e:
+                # Unreadable cache entry, drop it and query the catalogue instead
+                logger.warning(f"Ignoring corrupt search cache {cache_file}: {str(e)}")
+                cache_file.unlink(missing_ok=True)
+        
         max_attempts = 3
-        wait_time = 30
         
         for attempt in range(max_attempts):
             try:
-                footprint = self.create_search_polygon(region)
-                if not footprint:
-                    logger.error(f"Invalid region: {region}")
-                    return []
-
-                logger.info(f"Searching for L2A scenes in {region} from {start_date} to {end_date}")
-                
-                # Format dates
-                start_str = start_date.strftime("%Y-%m-%dT%H:%M:%SZ")
-                end_str = end_date.strftime("%Y-%m-%dT%H:%M:%SZ")
-                
-                # Simplified query with less restrictive filters
-                query = (
-                    f"{self.base_url}/Products?$filter="
-                    f"Collection/Name eq 'SENTINEL-2' "
-                    f"and contains(Name,'MSIL2A') "
-                    f"and OData.CSC.Intersects(area=geography'SRID=4326;{footprint}') "
-                    f"and ContentDate/Start ge '{start_str}' "  # Changed gt to ge (greater or equal)
-                    f"and ContentDate/Start le '{end_str}' "    # Changed lt to le (less or equal)
-                    f"and Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' "
-                    f"and att/Value le {max_cloud_percentage})"
-                    f"&$orderby=ContentDate/Start desc"
-                )
-                
-                logger.debug(f"Query URL: {query}")  # Add this line to debug the query
-                
-                response = requests.get(
-                    query,
-                    headers=self.headers
-                )
+                self.ensure_token()
+                response = self.session.get(query)
                 
                 if response.status_code == 200:
-                    products = response.json().get('value', [])
-                    logger.debug(f"Raw API response: {response.text}")  # Add this line for debugging
+                    page = orjson.loads(response.content)
+                    products = page.get('value', [])
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Raw API response: {response.text}")  # Add this line for debugging
+                    
+                    # Follow pagination so results past the first $top are not dropped
+                    next_link = page.get('@odata.nextLink')
+                    while next_link:
+                        response = self.session.get(next_link)
+                        if response.status_code != 200:
+                            raise Exception(f"Search failed: {response.text}")
+                        page = orjson.loads(response.content)
+                        products.extend(page.get('value', []))
+                        next_link = page.get('@odata.nextLink')
+                    
+                    self.write_search_cache(cache_file, products)
                     
                     if not products:
-                        logger.warning(f"No products found for region {region} in date range")
+                        logger.warning(f"No products found for region {area_name} in date range")
                         return []
                     
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Attributes per product: {[len(p.get('Attributes', [])) for p in products]}")
                     logger.info(f"Found {len(products)} products")
                     return products
                 else:
@@ -139,49 +412,76 @@ class MoroccoSentinelDownloader:
                 
             except Exception as e:
                 if attempt < max_attempts - 1:
-                    wait_time *= (attempt + 1)
-                    logger.warning(f"Search error, retrying in {wait_time} seconds... ({attempt + 1}/{max_attempts})")
+                    wait_time = backoff_delay(attempt, SEARCH_BACKOFF_BASE, SEARCH_MAX_BACKOFF)
+                    logger.warning(f"Search error, retrying in {wait_time:.1f} seconds... ({attempt + 1}/{max_attempts})")
                     time.sleep(wait_time)
-                    self.get_token()
+                    self.ensure_token(force=True)
                 else:
                     logger.error(f"Failed after {max_attempts} attempts: {str(e)}")
                     return []
 
+    def write_search_cache(self, cache_file, products):
+        """Write search results atomically so an interrupted write can't leave a corrupt entry"""
+        try:
+            self.search_cache_dir.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.search_cache_dir, suffix='.tmp')
+        except OSError as e:
+            logger.warning(f"Could not write search cache: {str(e)}")
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(orjson.dumps(products))
+            os.replace(tmp_path, cache_file)
+        except BaseException as e:
+            os.unlink(tmp_path)
+            if not isinstance(e, OSError):
+                raise
+            logger.warning(f"Could not write search cache: {str(e)}")
+
     def get_cloud_cover(self, product):
-        """Extract cloud cover from product metadata safely"""
+        """Extract cloud cover from any product metadata layout, cached per product Id (for debugging)"""
+        product_id = product.get('Id')
+        if product_id in self.cloud_cover_cache:
+            return self.cloud_cover_cache[product_id]
+        
         try:
             # Try different possible locations for cloud cover
             if 'CloudCover' in product:
-                return float(product['CloudCover'])
+                cloud_cover = float(product['CloudCover'])
             elif 'Properties' in product and 'cloudCover' in product['Properties']:
-                return float(product['Properties']['cloudCover'])
-            elif 'Attributes' in product:
-                for attr in product['Attributes']:
-                    if attr.get('Name') == 'cloudCover':
-                        return float(attr.get('Value', 100))
-            return 100  # Default if not found
+                cloud_cover = float(product['Properties']['cloudCover'])
+            else:
+                attributes = {attr.get('Name'): attr.get('Value', 100) for attr in product.get('Attributes', ())}
+                cloud_cover = float(attributes.get('cloudCover', 100))  # Default if not found
         except (ValueError, TypeError):
-            return 100
+            cloud_cover = 100
+        
+        if product_id is not None:
+            self.cloud_cover_cache[product_id] = cloud_cover
+        return cloud_cover
 
     def download_sentinel_images(self, regions, start_date, end_date, output_base_dir, 
-                            max_cloud_percentage=30):
+                            max_cloud_percentage=30, max_parallel_downloads=5, force_refresh=False):
         """Main download method"""
         output_base_dir = Path(output_base_dir)
         output_base_dir.mkdir(parents=True, exist_ok=True)
         
         total_products = 0
-        downloaded_products = 0
         
         # First, search and collect products for all regions
         products_by_region = {}
         print("\nSearching for products in all regions:")
+        # One catalogue query covers all regions
+        searched = self.search_regions(
+            regions,
+            start_date,
+            end_date,
+            max_cloud_percentage,
+            force_refresh
+        )
+        
         for region in regions:
-            products = self.search_scenes(
-                region,
-                start_date,
-                end_date,
-                max_cloud_percentage
-            )
+            products = searched[region]
             products_by_region[region] = products
             print(f"- {region}: {len(products)} products found")
             total_products += len(products)
@@ -189,36 +489,9 @@ class MoroccoSentinelDownloader:
         print(f"\nTotal products found across all regions: {total_products}")
         print("\nStarting downloads...")
         
-        # Process each region
-        for region, products in products_by_region.items():
-            logger.info(f"\nProcessing region: {region}")
-            print(f"\nProcessing region: {region}")
-            
-            region_dir = output_base_dir / region
-            region_dir.mkdir(exist_ok=True)
-            
-            if products:
-                # Sort products by cloud cover
-                sorted_products = sorted(products, key=lambda x: self.get_cloud_cover(x))
-                
-                for product in sorted_products:
-                    try:
-                        cloud_cover = self.get_cloud_cover(product)
-                        print(f"\nDownloading: {product['Name']}")
-                        print(f"Cloud coverage: {cloud_cover:.1f}%")
-                        print(f"Product ID: {product['Id']}")
-                        
-                        if self.download_product(product, str(region_dir)):
-                            downloaded_products += 1
-                            print(f"Successfully downloaded: {product['Name']}")
-                        
-                        # Add delay between downloads
-                        time.sleep(5)
-                        
-                    except Exception as e:
-                        logger.error(f"Error processing {product['Name']}: {str(e)}")
-            else:
-                print(f"No products found for {region}")
+        downloaded_products = asyncio.run(
+            self.download_all(products_by_region, output_base_dir, max_parallel_downloads)
+        )
         
         # Print final summary
         print("\nDownload Summary:")
@@ -226,13 +499,183 @@ class MoroccoSentinelDownloader:
         print(f"Successfully downloaded: {downloaded_products}")
         print(f"Failed downloads: {total_products - downloaded_products}")
 
-    def download_product(self, product, output_dir):
-        """Download a single product"""
+    async def download_all(self, products_by_region, output_base_dir, max_parallel_downloads=5):
+        """Download all products concurrently, returns the number of successful downloads"""
+        # Limit parallel downloads to avoid CDSE rate limiting (HTTP 429)
+        limiter = DownloadLimiter(max_parallel_downloads)
+        connector = aiohttp.TCPConnector(limit=8)
+        
+        async with aiohttp.ClientSession(connector=connector, timeout=DOWNLOAD_TIMEOUT) as session:
+            tasks = []
+            for region, products in products_by_region.items():
+                logger.info(f"\nProcessing region: {region}")
+                print(f"\nProcessing region: {region}")
+                
+                region_dir = output_base_dir / region
+                region_dir.mkdir(exist_ok=True)
+                
+                if not products:
+                    print(f"No products found for {region}")
+                    continue
+                
+                # Sort products by cloud cover, already filtered server side
+                sorted_products = sorted(products, key=cloud_cover_key)
+                
+                for product in sorted_products:
+                    tasks.append(self.download_with_limit(session, limiter, product, region_dir))
+            
+            results = await asyncio.gather(*tasks)
+        
+        return sum(results)
+
+    async def download_with_limit(self, session, limiter, product, region_dir):
+        """Download a product once a slot is free, re-queueing it when rate limited"""
+        for rate_limit_attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            try:
+                async with limiter:
+                    cloud_cover = cloud_cover_key(product)
+                    print(f"\nDownloading: {product['Name']}")
+                    print(f"Cloud coverage: {cloud_cover:.1f}%")
+                    print(f"Product ID: {product['Id']}")
+                    
+                    success = await self.download_product(session, product, str(region_dir), limiter)
+                    if success:
+                        print(f"Successfully downloaded: {product['Name']}")
+                        await limiter.succeeded()
+                    return success
+                    
+            except RateLimitError as e:
+                # Release the slot while waiting so other downloads can proceed
+                await limiter.throttled()
+                if rate_limit_attempt == MAX_RATE_LIMIT_RETRIES:
+                    break
+                logger.warning(f"Rate limited on {product['Name']}, re-queueing in {e.retry_after} seconds")
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"Error processing {product['Name']}: {str(e)}")
+                return False
+        
+        logger.error(f"Giving up on {product['Name']}: still rate limited after {MAX_RATE_LIMIT_RETRIES} retries")
+        return False
+
+    def get_retry_after(self, response, default=30):
+        """Read the Retry-After header in seconds"""
+        try:
+            return int(response.headers.get('Retry-After', default))
+        except ValueError:
+            return default
+
+    async def get_range_size(self, session, url, headers):
+        """Return the size of a download if the server supports byte ranges, else 0"""
+        async with session.get(url, headers={**headers, 'Range': 'bytes=0-0'}) as r:
+            if r.status == 429:
+                raise RateLimitError(self.get_retry_after(r))
+            r.raise_for_status()
+            content_range = r.headers.get('Content-Range', '')
+            if r.status != 206 or '/' not in content_range:
+                return 0
+            size = content_range.rsplit('/', 1)[1]
+            return int(size) if size.isdigit() else 0
+
+    async def download_ranges(self, session, url, headers, output_file, done, total_size, streams, desc):
+        """Download the bytes not in done as at most streams parallel range requests written in place"""
+        missing = missing_ranges(done, total_size)
+        piece_size = max(-(-sum(hi - lo for lo, hi in missing) // streams), DOWNLOAD_CHUNK_SIZE)
+        parts = [(lo, min(lo + piece_size, hi)) for start, hi in missing for lo in range(start, hi, piece_size)]
+        # Offset reached by each part, recorded on failure so finished bytes aren't fetched again
+        offsets = [lo for lo, _ in parts]
+        progress_file = output_file.with_name(output_file.name + '.ranges')
+        gate = asyncio.Semaphore(streams)
+        
+        fd = os.open(output_file, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if not done:
+                # Nothing worth keeping, e.g. a stale oversized file
+                os.ftruncate(fd, 0)
+            os.ftruncate(fd, total_size)
+            preallocate_file(fd, total_size)
+            with tqdm(
+                total=total_size,
+                initial=total_size - sum(hi - lo for lo, hi in missing),
+                unit='iB',
+                unit_scale=True,
+                desc=desc
+            ) as pbar:
+                tasks = [
+                    asyncio.ensure_future(self.download_range(session, url, headers, fd, parts, offsets, i, pbar, gate))
+                    for i in range(len(parts))
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    # Stop the remaining ranges before the file is closed
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    
+                    # Record every byte written so the next attempt only fetches what is missing
+                    done = merge_ranges(list(done) + [(lo, offset) for (lo, _), offset in zip(parts, offsets) if offset > lo])
+                    tmp_file = progress_file.with_name(progress_file.name + '.tmp')
+                    tmp_file.write_bytes(orjson.dumps(done))
+                    os.replace(tmp_file, progress_file)
+                    raise
+            await asyncio.to_thread(drop_file_cache, fd, total_size)
+        finally:
+            os.close(fd)
+        progress_file.unlink(missing_ok=True)
+
+    async def download_range(self, session, url, headers, fd, parts, offsets, index, pbar, gate):
+        """Download parts[index] ([start, end) bounds) into fd at the same offset"""
+        start, end = parts[index]
+        async with gate, session.get(url, headers={**headers, 'Range': f'bytes={start}-{end - 1}'}) as r:
+            if r.status == 429:
+                raise RateLimitError(self.get_retry_after(r))
+            r.raise_for_status()
+            if r.status != 206:
+                raise Exception(f"Server ignored range request for bytes {start}-{end - 1}")
+            
+            async for chunk in iter_buffered(r.content):
+                write = asyncio.ensure_future(asyncio.to_thread(pwrite_all, fd, chunk, offsets[index]))
+                try:
+                    await asyncio.shield(write)
+                except asyncio.CancelledError:
+                    # The write thread can't be stopped, let it finish before the fd is closed
+                    await asyncio.wait({write})
+                    raise
+                offsets[index] += len(chunk)
+                pbar.update(len(chunk))
+        
+        if offsets[index] != end:
+            raise Exception(f"Incomplete range: got bytes {start}-{offsets[index] - 1} of {start}-{end - 1}")
+
+    def load_done_ranges(self, part_file, existing, total_size):
+        """Byte ranges of part_file already downloaded by an earlier attempt"""
+        progress_file = part_file.with_name(part_file.name + '.ranges')
+        if progress_file.exists():
+            try:
+                done = [(lo, hi) for lo, hi in orjson.loads(progress_file.read_bytes())]
+                # Range downloads keep the file at full size, anything else is stale
+                if existing == total_size and all(0 <= lo < hi <= total_size for lo, hi in done):
+                    return done
+            except (orjson.JSONDecodeError, OSError, TypeError, ValueError):
+                pass
+            logger.warning(f"Ignoring stale download progress {progress_file}")
+            progress_file.unlink(missing_ok=True)
+            return []
+        
+        # Streamed downloads write contiguously, so the file size is the resume point.
+        # A full-size file without progress may be an interrupted preallocated one.
+        if 0 < existing < total_size:
+            return [(0, existing)]
+        return []
+
+    async def download_product(self, session, product, output_dir, limiter=None):
+        """Download a single product, resuming any partial download"""
         max_retries = 3
-        retry_delay = 30
         
         for attempt in range(max_retries):
             try:
+                await asyncio.to_thread(self.ensure_token)
                 product_id = product['Id']
                 product_title = product['Name']
                 
@@ -241,33 +684,91 @@ class MoroccoSentinelDownloader:
                 
                 logger.info(f"Downloading product with bands B02(Blue), B03(Green), B04(Red), B08(NIR) at 10m resolution")
                 
-                # Start download with streaming
-                with requests.get(download_url, headers=self.headers, stream=True) as r:
+                # Zip files are already compressed, ask for the raw bytes
+                headers = {**self.headers, 'Accept-Encoding': 'identity'}
+                output_file = Path(output_dir) / f"{product_title}.zip"
+                desc = f"{product_title} (10m - B02,B03,B04,B08)"
+                
+                # Downloads go to a .part file that is renamed once complete
+                part_file = output_file.with_name(output_file.name + '.part')
+                existing = part_file.stat().st_size if part_file.exists() else 0
+                
+                # Split large products into parallel range requests when the server allows it
+                range_size = await self.get_range_size(session, download_url, headers)
+                
+                # Only skip an existing zip whose size matches the product, older runs wrote partial zips
+                if range_size > 0 and output_file.exists() and output_file.stat().st_size == range_size:
+                    logger.info(f"{product_title} already downloaded, skipping")
+                    return True
+                
+                if range_size > 0 and hasattr(os, 'pwrite'):
+                    done = self.load_done_ranges(part_file, existing, range_size)
+                    # Extra streams take free download slots so the total stays within the limit
+                    wanted = DOWNLOAD_RANGE_PARTS - 1
+                    extra = await limiter.acquire_extra(wanted) if limiter else wanted
+                    try:
+                        await self.download_ranges(
+                            session, download_url, headers, part_file, done, range_size, 1 + extra, desc
+                        )
+                    finally:
+                        if limiter:
+                            await limiter.release_extra(extra)
+                    part_file.replace(output_file)
+                    return True
+                
+                # Start download with streaming, resuming from the bytes already on disk
+                progress_file = part_file.with_name(part_file.name + '.ranges')
+                if progress_file.exists():
+                    # Left by a range download, the file has holes so start over
+                    progress_file.unlink()
+                    existing = 0
+                if existing:
+                    headers['Range'] = f'bytes={existing}-'
+                async with session.get(download_url, headers=headers) as r:
+                    if r.status == 429:
+                        raise RateLimitError(self.get_retry_after(r))
                     r.raise_for_status()
-                    total_size = int(r.headers.get('content-length', 0))
-                    
-                    output_file = Path(output_dir) / f"{product_title}.zip"
-                    
-                    with open(output_file, 'wb') as f:
-                        with tqdm(
-                            total=total_size,
-                            unit='iB',
-                            unit_scale=True,
-                            desc=f"{product_title} (10m - B02,B03,B04,B08)"
-                        ) as pbar:
-                            for chunk in r.iter_content(chunk_size=8192):
-                                size = f.write(chunk)
-                                pbar.update(size)
+                    if r.status != 206:
+                        # Server sent the whole file, overwrite
+                        existing = 0
+                    total_size = existing + int(r.headers.get('content-length', 0))
                     
+                    written = existing
+                    try:
+                        # r+b rather than append so writes land after the resumed bytes, not after the preallocation
+                        async with aiofiles.open(part_file, 'r+b' if existing else 'wb') as f:
+                            await f.seek(existing)
+                            preallocate_file(f.fileno(), total_size)
+                            with tqdm(
+                                total=total_size,
+                                initial=existing,
+                                unit='iB',
+                                unit_scale=True,
+                                desc=desc
+                            ) as pbar:
+                                async for chunk in iter_buffered(r.content):
+                                    await f.write(chunk)
+                                    written += len(chunk)
+                                    pbar.update(len(chunk))
+                            await f.flush()
+                            await asyncio.to_thread(drop_file_cache, f.fileno(), total_size)
+                    finally:
+                        # Drop any preallocated tail so the next attempt resumes at the right byte
+                        if part_file.exists() and part_file.stat().st_size > written:
+                            os.truncate(part_file, written)
+                
+                part_file.replace(output_file)
                 return True
                 
+            except RateLimitError:
+                raise
             except Exception as e:
                 if attempt < max_retries - 1:
-                    retry_delay *= (attempt + 1)
-                    logger.warning(f"Download failed, retrying in {retry_delay} seconds... ({attempt + 1}/{max_retries})")
-                    time.sleep(retry_delay)
+                    retry_delay = backoff_delay(attempt, DOWNLOAD_BACKOFF_BASE, DOWNLOAD_MAX_BACKOFF)
+                    logger.warning(f"Download failed, retrying in {retry_delay:.1f} seconds... ({attempt + 1}/{max_retries})")
+                    await asyncio.sleep(retry_delay)
                     # Refresh token before retry
-                    self.get_token()
+                    await asyncio.to_thread(self.ensure_token, True)
                 else:
                     logger.error(f"Failed to download after {max_retries} attempts: {str(e)}")
                     return False